@@ -6,7 +6,6 @@ import numpy as np
 import json
 import shutil
 import pprint
-import warnings
 import tqdm
 from collections import defaultdict, Counter
 from snorkel import SnorkelSession
@@ -17,7 +16,7 @@ from tcre.supervision import get_candidate_classes, ENT_TYP_CT_L, ENT_TYP_CK_L,
 from tcre.modeling import utils
 from tcre.modeling import features
 from tcre.modeling import data as tcre_data
-from tcre.modeling.vocab import W2VVocab
+from tcre.modeling.vocab import W2VVocab, load_w2v_vectors
 from tcre.modeling.training import supervise, load_checkpoint, set_seed
 from tcre.exec.v1.model import RERNN, DIST_PAD_VAL
 from torchtext import data as txd
@@ -108,14 +107,22 @@ def _splits(splits_file, keys=None):
     return splits
 
 
-def _cands(candidate_class, splits):
+def _cands(candidate_class, splits, chunk_size=900):
     cids = list(set([cid for s, cids in splits.items() for cid in cids]))
-    # Shortcut to get all candidates (circumvents "Too many SQL variables" errors)
+    # Shortcut to get all candidates
     if len(cids) == 1 and isinstance(cids[0], str) and cids[0] == 'all':
         return session.query(candidate_class.subclass).all()
-    else:
-        return session.query(candidate_class.subclass) \
-            .filter(candidate_class.subclass.id.in_(cids)).all()
+    # Otherwise, query for ids in chunks small enough to stay under bound parameter limits
+    # (e.g. 999 for SQLite, which otherwise results in "Too many SQL variables" errors);
+    # note that all candidates are still materialized since callers index into the result
+    cands = []
+    for i in range(0, len(cids), chunk_size):
+        cands.extend(
+            session.query(candidate_class.subclass)
+            .filter(candidate_class.subclass.id.in_(cids[i:(i + chunk_size)]))
+            .all()
+        )
+    return cands
 
 
 def get_model(fields, config):
@@ -135,9 +142,10 @@ def get_model(fields, config):
 
 def _label_dist(y, nunique_max=10):
     y = pd.cut(y, nunique_max) if y.nunique() > nunique_max else y
+    counts = y.value_counts()
     return pd.concat([
-        y.value_counts().rename('count'),
-        y.value_counts(normalize=True).rename('percent')
+        counts.rename('count'),
+        (counts / counts.sum()).rename('percent')
     ], axis=1).sort_index()
 
 
@@ -184,57 +192,89 @@ def _datasets(cands, splits, config, fields, allow_null_label=False):
         logger.info('Simulating labels using strategy "%s"', config['simulation_strategy'])
         df['label'] = simulation.get_simulated_labels(df, config['simulation_strategy'])
 
-    if allow_null_label:
-        labels_valid = (df['label'].isnull() | df['label'].between(0, 1))
-    else:
-        labels_valid = df['label'].between(0, 1)
-    if not labels_valid.all():
-        ex = df['label'][~labels_valid].unique()
+    # Check bounds using reductions first and only build a mask of invalid labels on failure
+    label = df['label']
+    if label.min() < 0 or label.max() > 1 or (not allow_null_label and label.hasnans):
+        labels_valid = label.between(0, 1)
+        if allow_null_label:
+            labels_valid |= label.isnull()
+        ex = label[~labels_valid].unique()
         raise AssertionError(f"Found label values outside [0, 1]; Examples: {ex[:10]}")
 
-    logger.info(f'Sample feature records:\n')
-    for r in df.head(5).to_dict(orient='records'):
-        logger.info(pprint.pformat(r, width=128, compact=True, indent=6))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Sample feature records:\n')
+        for r in df.head(5).to_dict(orient='records'):
+            logger.debug(pprint.pformat(r, width=128, compact=True, indent=6))
 
     # Build dataset for each split (one candidate may exist in multiple splits)
     logger.info('Initializing batch iterators')
-    dfi = df.set_index('id', drop=False)
-    datasets = pd.DataFrame([
-        dfi.loc[cid].append(pd.Series({'split': s}))
-        for s, cids in splits.items() for cid in cids
-    ]).reset_index(drop=True)
+    ids = pd.DataFrame(
+        [(cid, s) for s, cids in splits.items() for cid in cids],
+        columns=['id', 'split']
+    )
+    found = ids['id'].isin(df['id'])
+    if not found.all():
+        missing = ids['id'][~found].unique()
+        raise KeyError(f'Failed to find features for candidate ids in splits; Examples: {missing[:10]}')
+    # Use a left merge as it preserves the order of ids within each split (inner merges
+    # group rows by key prior to pandas 2.2), which balancing and iterator sorting depend on
+    datasets = ids.merge(df, on='id', how='left', validate='many_to_one')
 
     datasets = {
         k: tcre_data.DataFrameDataset(_prepare(g, config).drop('split', axis=1), fields)
         for k, g in datasets.groupby('split')
     }
 
+    # Cache sequence lengths once per example for use as iterator sort keys
+    for ds in datasets.values():
+        for ex in ds.examples:
+            ex.text_len = len(ex.text)
+
     return datasets
 
 
+def _sort_key(ex):
+    return ex.text_len
+
+
 def _predict_dataset(model, dataset, config):
 
     iterator = Iterator(
         dataset,
         config['batch_size'],
-        sort_key=lambda x: len(x.text),
+        sort_key=_sort_key,
         sort_within_batch=True,
         repeat=False,
         shuffle=False,
         device=config['device']
     )
 
-    with torch.no_grad():
-        predictions = []
+    # Write results into preallocated device buffers and transfer them to the host only
+    # once all batches are done (one copy per output rather than three per batch and
+    # no per-batch DataFrame); note that the model itself still synchronizes on every
+    # batch (e.g. for sequence lengths in RERNN.forward)
+    n, device = len(dataset), config['device']
+    ids = torch.empty(n, dtype=torch.int64, device=device)
+    y_true = torch.empty(n, dtype=torch.float32, device=device)
+    y_pred = torch.empty(n, dtype=torch.float32, device=device)
+
+    # Note that inference_mode is only available in torch >= 1.9
+    with getattr(torch, 'inference_mode', torch.no_grad)():
+        offset = 0
         for batch in iterator:
-            predictions.append(pd.DataFrame({
-                'id': batch.id.clone().cpu().numpy(),
-                'y_true': batch.label.clone().cpu().numpy(),
-                'y_pred': model.predict(batch).clone().cpu().numpy()
-            }))
-        predictions = pd.concat(predictions).reset_index(drop=True)
+            size = len(batch)
+            ids[offset:(offset + size)] = batch.id
+            y_true[offset:(offset + size)] = batch.label
+            y_pred[offset:(offset + size)] = model.predict(batch)
+            offset += size
+    if offset != n:
+        raise AssertionError(f'Expecting {n} predictions but {offset} were generated')
 
-    return predictions
+    return pd.DataFrame({
+        'id': ids.cpu().numpy(),
+        'y_true': y_true.cpu().numpy(),
+        'y_pred': y_pred.cpu().numpy()
+    })
 
 
 def _predict(cands, config, cand_batch_size=100000):
@@ -250,12 +290,14 @@ def _predict(cands, config, cand_batch_size=100000):
     # Load model weights
     checkpoint_dir = output_dir / 'checkpoints'
     logger.info(f'Loading model state from checkpoint dir {checkpoint_dir}')
-    checkpoint = load_checkpoint(checkpoint_dir)
+    checkpoint = load_checkpoint(checkpoint_dir, map_location='cpu', keys=['model'])
 
     # Load fields
     with (output_dir / 'fields.pkl').open('rb') as f:
         fields = dill.load(f)
 
+    # Parameters are created on the cpu and weights are loaded there as well,
+    # so only a single copy to the target device is needed
     model, model_args = get_model(fields, config)
     model.load_state_dict(checkpoint['model'])
     logger.info(f'Restored model with arguments: {model_args}')
@@ -263,6 +305,13 @@ def _predict(cands, config, cand_batch_size=100000):
     model = model.to(config['device'])
     model.eval()
 
+    # Half precision RNN kernels are only available through cuDNN
+    if config.get('half_precision'):
+        if torch.device(config['device']).type != 'cuda':
+            raise ValueError(f"Half precision prediction requires a cuda device (device = {config['device']})")
+        logger.info('Converting model to half precision')
+        model = model.half()
+
     predictions = []
     n_batch = int(np.ceil(len(cands) / float(cand_batch_size)))
     logger.info('Beginning predictions for %s candidate batches', n_batch)
@@ -296,12 +345,15 @@ def _train(cands, splits, config):
     if len({'train', 'val', 'test'} - set(splits.keys())) > 0:
         raise ValueError(f'Splits must contain keys "train", "val", "test", got keys {splits.keys()}')
 
-    # Note that all fields default to type torch.int64
+    # Note that all fields default to type torch.int64; distances are bounded by DIST_PAD_VAL
+    # so they use a narrower type to reduce transfer size
     fields = {
         'text': txd.Field(sequential=True, lower=False, fix_length=SEQ_LEN, include_lengths=True),
         'label': txd.Field(sequential=False, use_vocab=False, dtype=torch.float32),
-        'e0_dist': txd.Field(sequential=True, use_vocab=False, pad_token=DIST_PAD_VAL, fix_length=SEQ_LEN),
-        'e1_dist': txd.Field(sequential=True, use_vocab=False, pad_token=DIST_PAD_VAL, fix_length=SEQ_LEN),
+        'e0_dist': txd.Field(sequential=True, use_vocab=False, pad_token=DIST_PAD_VAL, fix_length=SEQ_LEN,
+                             dtype=torch.int32),
+        'e1_dist': txd.Field(sequential=True, use_vocab=False, pad_token=DIST_PAD_VAL, fix_length=SEQ_LEN,
+                             dtype=torch.int32),
         'id': txd.Field(sequential=False, use_vocab=False)
     }
 
@@ -310,12 +362,9 @@ def _train(cands, splits, config):
     # If using w2v, set text field vocabulary on all datasets
     if config['wrd_embedding_type'].startswith('w2v'):
         specials = features.get_specials(markers=config['markers'], swaps=config['swaps'])
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", message='.*')
-            from gensim.models import KeyedVectors
-            logger.info(f"Loading w2v model with vocab limit {config['vocab_limit']} (specials = {specials})")
-            w2v = KeyedVectors.load_word2vec_format(W2V_MODEL_01, binary=True, limit=config['vocab_limit'])
-            fields['text'].vocab = W2VVocab(w2v, specials=specials, random_state=config['seed'])
+        logger.info(f"Loading w2v model with vocab limit {config['vocab_limit']} (specials = {specials})")
+        w2v = load_w2v_vectors(W2V_MODEL_01, limit=config['vocab_limit'])
+        fields['text'].vocab = W2VVocab(w2v, specials=specials, random_state=config['seed'])
     # Build vocab on training dataset text field ONLY and assign to others
     elif config['wrd_embedding_type'] == 'denovo':
         fields['text'].build_vocab(datasets['train'])
@@ -327,7 +376,7 @@ def _train(cands, splits, config):
     train_iter, val_iter, test_iter = BucketIterator.splits(
         tuple([datasets[k] for k in ['train', 'val', 'test']]),
         batch_sizes=[config['batch_size']]*3,
-        sort_key=lambda x: len(x.text),
+        sort_key=_sort_key,
         sort=True,
         sort_within_batch=True,
         repeat=False,
@@ -346,6 +395,7 @@ def _train(cands, splits, config):
         model_dir=config['output_dir'] if config['use_checkpoints'] else None,
         log_iter_interval=config['log_iter_interval'],
         log_epoch_interval=config['log_epoch_interval'],
+        train_eval_interval=config['train_eval_interval'],
         seed=config['seed']
     )
     return history, fields
@@ -414,6 +464,8 @@ def cli(ctx, relation_class, device, batch_size, output_dir, seed, log_level):
 @param('--balance', default=None, help='Desired fraction of positive examples in training data (e.g. 0.5)')
 @param('--log-iter-interval', default=10, help='Number of batches in training between logging messages')
 @param('--log-epoch-interval', default=1, help='Number of epochs in training between logging messages')
+@param('--train-eval-interval', default=5,
+       help='Number of epochs in training between evaluations on the training set (0 to disable)')
 @param('--save-keys', default='history,config,fields',
               help='Resulting data to save as csv list (output_dir must be set to have an effect)')
 @param('--simulation-strategy', default=None,
@@ -422,7 +474,7 @@ def cli(ctx, relation_class, device, batch_size, output_dir, seed, log_level):
 def train(ctx, splits_file, marker_list, swap_list, use_checkpoints, use_secondary, use_swaps, use_lower, use_positions,
         wrd_embedding_type, vocab_limit, model_size, bidirectional, cell_type,
         weight_decay, dropout, learning_rate, balance, log_iter_interval, log_epoch_interval,
-        save_keys, simulation_strategy):
+        train_eval_interval, save_keys, simulation_strategy):
     relation_class = ctx.obj['relation_class']
     candidate_class = _to_candidate_class(relation_class)
     output_dir = ctx.obj['output_dir']
@@ -454,6 +506,7 @@ def train(ctx, splits_file, marker_list, swap_list, use_checkpoints, use_seconda
         balance=balance,
         log_iter_interval=log_iter_interval,
         log_epoch_interval=log_epoch_interval,
+        train_eval_interval=train_eval_interval,
         simulation_strategy=simulation_strategy,
         device=ctx.obj['device'],
         batch_size=ctx.obj['batch_size'],
@@ -500,8 +553,9 @@ def train(ctx, splits_file, marker_list, swap_list, use_checkpoints, use_seconda
 @cli.command()
 @param('--splits-file', default=None, required=True,
        help='Path to json file containing candidate ids keyed by split name ("predict")')
+@param('--half-precision', default=False, type=bool, help='Use float16 weights for prediction (cuda only)')
 @click.pass_context
-def predict(ctx, splits_file):
+def predict(ctx, splits_file, half_precision):
     candidate_class = _to_candidate_class(ctx.obj['relation_class'])
     output_dir = ctx.obj['output_dir']
 
@@ -509,6 +563,7 @@ def predict(ctx, splits_file):
     config = json.loads((pl.Path(output_dir) / 'config.json').read_text('utf-8'))
     for prop in ['device', 'batch_size']:
         config[prop] = ctx.obj[prop]
+    config['half_precision'] = half_precision
 
     splits = _splits(splits_file, keys=['predict'])
     cands = _cands(candidate_class, splits)
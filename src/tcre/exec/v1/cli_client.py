@@ -7,7 +7,7 @@ def get_default_client():
     return Client(require_options=True, exceptions=[
         'log_level', 'seed', 'vocab_limit', 'use_lower', 'save_keys',
         'log_iter_interval', 'log_epoch_interval', 'balance', 'batch_size',
-        'simulation_strategy', 'swap_list'
+        'simulation_strategy', 'swap_list', 'train_eval_interval', 'half_precision'
     ])
 
 
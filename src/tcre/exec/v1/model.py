@@ -113,11 +113,11 @@ class RERNN(nn.Module):
         # Text index sequences and associated lengths
         X, L = text[0].t(), text[1]
         # Example ids (integers)
-        I = ids.type(torch.IntTensor)
+        I = ids.int()
         # Convert relative positions (as pos/neg integers or pad) to embedding indices
         D0, D1 = [pos_indices(v.t(), self.max_dist, DIST_PAD_VAL) for v in [e0_dist, e1_dist]]
         # Example labels
-        Y = None if label is None else label.type(torch.FloatTensor).to(self.device)
+        Y = None if label is None else label.float().to(self.device)
         features = (X, L, D0, D1, I)
         return tuple([f.to(self.device) for f in features]), Y
 
@@ -135,7 +135,8 @@ class RERNN(nn.Module):
         H = self.initial_hidden_state(len(X))
         X = self.wrd_embed(X)
         if self.pos_embed_dim:
-            D = torch.cat([self.pos_embed_e0(D0), self.pos_embed_e1(D1)], dim=-1)
+            # Embedding lookups require int64 indices
+            D = torch.cat([self.pos_embed_e0(D0.long()), self.pos_embed_e1(D1.long())], dim=-1)
             X = torch.cat([X, D], dim=-1)
         L = L.view(-1).tolist()
         X = nn.utils.rnn.pack_padded_sequence(X, L, batch_first=True)
@@ -147,7 +148,10 @@ class RERNN(nn.Module):
 
     def initial_hidden_state(self, batch_size):
         def get_h0():
-            return torch.zeros(self.num_layers * self.num_directions, batch_size, self.hidden_dim).to(self.device)
+            return torch.zeros(
+                self.num_layers * self.num_directions, batch_size, self.hidden_dim,
+                dtype=self.output.weight.dtype
+            ).to(self.device)
 
         if self.cell_type == CT_GRU:
             return get_h0()
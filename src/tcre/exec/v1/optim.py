@@ -98,7 +98,8 @@ class TaskParameterOptimizer(object):
         splits_file = self.get_splits_file()
         train_opts = to_dict(x, self.space)
         return {
-            **dict(splits_file=splits_file, use_checkpoints=False, save_keys='"history"'),
+            # Score the training set every epoch so that all metrics are present at the best validation epoch
+            **dict(splits_file=splits_file, use_checkpoints=False, save_keys='"history"', train_eval_interval=1),
             **self.client_args.get('train', {}),
             **train_opts
         }
@@ -1,5 +1,6 @@
 from torchtext.data import Field, Dataset, Example
 import pandas as pd
+import torch
 
 
 class DataFrameDataset(Dataset):
@@ -16,7 +17,16 @@ class DataFrameDataset(Dataset):
                 filter_pred(example) is true, or use all examples if None.
                 Default is None
         """
-        self.examples = examples.apply(SeriesExample.fromSeries, args=(fields,), axis=1).tolist()
+        # Iterate over column arrays rather than rows to avoid creating a Series per example
+        for key in fields:
+            if key not in examples:
+                raise ValueError("Specified key {} was not found in "
+                                 "the input data".format(key))
+        keys = list(fields)
+        self.examples = [
+            SeriesExample.fromdict(dict(zip(keys, values)), fields)
+            for values in zip(*[examples[k].values for k in keys])
+        ]
         if filter_pred is not None:
             self.examples = filter(filter_pred, self.examples)
         self.fields = dict(fields)
@@ -48,3 +58,59 @@ class SeriesExample(Example):
                 setattr(ex, key, data[key])
 
         return ex
+
+
+class CudaPrefetchIterator(object):
+    """Iterator wrapper that copies the next batch to a cuda device on a side stream while the current one is used"""
+
+    def __init__(self, iterator, device):
+        """
+        Arguments:
+            iterator: Iterator over torchtext batches (e.g. BucketIterator)
+            device: Cuda device to copy batch tensors to
+        """
+        self.iterator = iterator
+        self.device = torch.device(device)
+
+    @property
+    def dataset(self):
+        return self.iterator.dataset
+
+    def __len__(self):
+        return len(self.iterator)
+
+    def _to_device(self, value):
+        # Fields with include_lengths=True produce (tensor, lengths) tuples
+        if isinstance(value, tuple):
+            return tuple(self._to_device(v) for v in value)
+        if torch.is_tensor(value):
+            return value.pin_memory().to(self.device, non_blocking=True)
+        return value
+
+    def _prefetch(self, batches, stream):
+        batch = next(batches, None)
+        if batch is not None:
+            with torch.cuda.device(self.device), torch.cuda.stream(stream):
+                for name in batch.fields:
+                    setattr(batch, name, self._to_device(getattr(batch, name)))
+        return batch
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.iterator)
+        batch = self._prefetch(batches, stream)
+        while batch is not None:
+            # Resolve the stream for the target device explicitly since it need not be the
+            # current device (e.g. when training on "cuda:1")
+            with torch.cuda.device(self.device):
+                current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(stream)
+            # Prevent the caching allocator from reusing memory allocated on the side
+            # stream before the main stream is done with it
+            for name in batch.fields:
+                value = getattr(batch, name)
+                for v in (value if isinstance(value, tuple) else (value,)):
+                    if torch.is_tensor(v):
+                        v.record_stream(current_stream)
+            current, batch = batch, self._prefetch(batches, stream)
+            yield current
@@ -114,6 +114,12 @@ def get_dist_bin(i, rng):
     return np.clip(v, -MAX_POS_DIST, MAX_POS_DIST)
 
 
+def get_dist_bins(i, rng):
+    """Vectorized version of `get_dist_bin` for an array of indices"""
+    v = np.where(i < rng[0], i - rng[0], np.where(i > rng[1], i - rng[1], 0))
+    return np.clip(v, -MAX_POS_DIST, MAX_POS_DIST)
+
+
 def get_specials(markers, swaps):
     specials = []
     # Extract tokens, ignoring None or empty strings
@@ -163,27 +169,25 @@ def get_record_features(records, markers=DEFAULT_MARKERS, swaps=DEFAULT_SWAPS,
 
         # Note that if the subtokenizer returns an empty sequence, the main index in this loop will be
         # skipped, which is useful for removing unwanted tokens in the sequence
-        subtokens = [(i0, t0, i1, t1) for i0, t0 in enumerate(tokens) for i1, t1 in enumerate(subtokenizer(t0))]
-        tokens = []
-        word_indices = []
-        token_indices = []
+        subtokens = [(i0, t1) for i0, t0 in enumerate(tokens) for t1 in subtokenizer(t0)]
+        token_indices = [i0 for i0, _ in subtokens]
+        word_indices = [indices[i0] for i0 in token_indices]
+        tokens = [t1 for _, t1 in subtokens]
         tags = ['O'] * len(subtokens)
-        entity_distances = [[] for _ in range(len(entity_indices))]
-        for i, (i0, t0, i1, t1) in enumerate(subtokens):
-            word_indices.append(indices[i0])
-            token_indices.append(i0)
-            token = t1
-            for ei, e in enumerate(rec['entities']):
-                rng = positions[ei]
-                typ = status[e['is_candidate']]  # primary/secondary
-                if typ == 'primary':
-                    entity_distances[entity_indices.index(ei)].append(get_dist_bin(i0, rng))
-                if rng[0] <= i0 <= rng[1]:
-                    tags[i] = f"E:{typ}:{e['type']}"
-                    if swaps and swaps[typ]:
-                        token = swaps[typ][e['type']]
-
-            tokens.append(token)
+
+        # Assign tags and swaps one entity at a time over the subtokens within its span
+        # (later entities take precedence where spans overlap)
+        token_positions = np.array(token_indices, dtype=np.int64)
+        for ei, e in enumerate(rec['entities']):
+            rng = positions[ei]
+            typ = status[e['is_candidate']]  # primary/secondary
+            for i in np.flatnonzero((token_positions >= rng[0]) & (token_positions <= rng[1])):
+                tags[i] = f"E:{typ}:{e['type']}"
+                if swaps and swaps[typ]:
+                    tokens[i] = swaps[typ][e['type']]
+
+        # Compute relative distances to each candidate entity for all subtokens at once
+        entity_distances = [get_dist_bins(token_positions, positions[ei]).tolist() for ei in entity_indices]
 
         features = dict(tokens=tokens, tags=tags)
 
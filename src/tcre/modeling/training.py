@@ -1,4 +1,5 @@
 import glob
+import re
 import pathlib as pl
 import numpy as np
 import shutil
@@ -12,6 +13,7 @@ from ignite.engine import Events, Engine, create_supervised_trainer, create_supe
 from ignite.contrib.handlers.param_scheduler import LRScheduler
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from tcre.modeling.metrics import get_f1_metric, PredictionAggregator
+from tcre.modeling.data import CudaPrefetchIterator
 import torch.optim as optim
 import torch.nn as nn
 import torch
@@ -40,11 +42,17 @@ def set_seed(seed):
 
 def supervise(model, lr, decay, train_iter, val_iter,
               test_iter=None, model_dir=None, max_epochs=250, es_patience=25, lr_patience=25,
-              log_iter_interval=10, log_epoch_interval=1, seed=0):
+              log_iter_interval=10, log_epoch_interval=1, train_eval_interval=1, seed=0):
     set_seed(seed)
 
     if test_iter is None:
         test_iter = val_iter
+
+    # Overlap host to device batch copies with computation when training on a gpu
+    if model.device is not None and torch.device(model.device).type == 'cuda':
+        train_iter, val_iter, test_iter = [
+            CudaPrefetchIterator(it, model.device) for it in [train_iter, val_iter, test_iter]]
+
     optimizer = optim.Adam([p for p in model.parameters() if p.requires_grad], lr=lr, weight_decay=decay)
     scheduler = ReduceLROnPlateau(optimizer, mode='min', factor=0.25, patience=lr_patience, threshold=0.01, verbose=True)
     criterion = nn.BCEWithLogitsLoss()
@@ -57,11 +65,19 @@ def supervise(model, lr, decay, train_iter, val_iter,
         device=model.device, prepare_batch=model.prepare
     )
 
+    # Probabilities and rounded labels for the most recent output, shared by all
+    # classification metrics (the output is retained so identity checks are safe)
+    transformed = {'output': None, 'values': None}
+
     def classify(output, thresh=.5):
-        y_pred, y = output
-        # Convert logits to 0/1 and round true values (which may be probabilistic)
-        # in evaluation ONLY
-        return model.transform(y_pred) > thresh, torch.round(y)
+        if transformed['output'] is not output[0]:
+            y_pred, y = output
+            # Convert logits to probabilities and round true values (which may be probabilistic)
+            # in evaluation ONLY
+            transformed['output'] = y_pred
+            transformed['values'] = model.transform(y_pred), torch.round(y)
+        y_prob, y = transformed['values']
+        return y_prob > thresh, y
 
     def get_metrics():
         metrics = OrderedDict({
@@ -77,34 +93,26 @@ def supervise(model, lr, decay, train_iter, val_iter,
         metrics['f1'] = get_f1_metric(metrics['precision'], metrics['recall'])
         return metrics
 
-    def get_evaluator():
-        return create_supervised_evaluator(
-            model, metrics=get_metrics(), prepare_batch=model.prepare, device=model.device,
-            # Do not use an output transform here as the loss metric requires logits and probabilistic labels
-        )
-
-    train_evaluator = get_evaluator()
-    val_evaluator = get_evaluator()
-    test_evaluator = get_evaluator()
+    # Use a single evaluator for all splits (metrics are reset at the start of every run)
+    evaluator = create_supervised_evaluator(
+        model, metrics=get_metrics(), prepare_batch=model.prepare, device=model.device,
+        # Do not use an output transform here as the loss metric requires logits and probabilistic labels
+    )
 
     def score_function(engine):
         return engine.state.metrics['f1']
 
-    val_evaluator.add_event_handler(
-        Events.EPOCH_COMPLETED,
-        EarlyStopping(patience=es_patience, score_function=score_function, trainer=trainer)
-    )
+    # Early stopping and checkpointing are invoked manually after validation runs only
+    # rather than attached as handlers since the evaluator is shared across splits
+    early_stopping = EarlyStopping(patience=es_patience, score_function=score_function, trainer=trainer)
+    checkpoint = None
     if model_dir is not None:
         if osp.exists(model_dir):
             shutil.rmtree(model_dir)
         os.makedirs(model_dir)
-        val_evaluator.add_event_handler(
-            Events.EPOCH_COMPLETED,
-            ModelCheckpoint(
-                dirname=model_dir, filename_prefix='model', score_function=score_function, score_name='f1',
-                create_dir=True, require_empty=True, n_saved=1
-            ),
-            {'model': model, 'optimizer': optimizer, 'scheduler': scheduler}
+        checkpoint = ModelCheckpoint(
+            dirname=model_dir, filename_prefix='model', score_function=score_function, score_name='f1',
+            create_dir=True, require_empty=True, n_saved=1
         )
     history = []
 
@@ -133,20 +141,32 @@ def supervise(model, lr, decay, train_iter, val_iter,
     @trainer.on(Events.EPOCH_COMPLETED)
     def log_training_results(engine):
         epoch, iteration = engine.state.epoch, engine.state.iteration
-        log_results(train_evaluator, train_iter, 'training', epoch, iteration)
-        log_results(test_evaluator, test_iter, 'test', epoch, iteration)
-        metric = log_results(val_evaluator, val_iter, 'validation', epoch, iteration)['f1']
+        # Scoring the training set is only informative so allow it to be skipped (or disabled with 0/None)
+        if train_eval_interval and epoch % train_eval_interval == 0:
+            log_results(evaluator, train_iter, 'training', epoch, iteration)
+        log_results(evaluator, test_iter, 'test', epoch, iteration)
+        metric = log_results(evaluator, val_iter, 'validation', epoch, iteration)['f1']
+        early_stopping(evaluator)
+        if checkpoint is not None:
+            checkpoint(evaluator, {'model': model, 'optimizer': optimizer, 'scheduler': scheduler})
         scheduler.step(metric)
 
     trainer.run(train_iter, max_epochs=max_epochs)
     return history
 
 
-def load_checkpoint(checkpoint_dir):
+def load_checkpoint(checkpoint_dir, map_location='cpu', keys=None):
     files = glob.glob(str(pl.Path(checkpoint_dir) / '*.pth'))
     comps = defaultdict(lambda: [])
     for f in files:
-        comps[pl.Path(f).name.split('_')[1]].append(torch.load(f))
+        # Checkpoint files are named as "{prefix}_{component}_{iteration}[_{score_name}={score}].pth"
+        match = re.match(r'^[^_]+_(?P<name>.+?)_\d+(?:_|$)', pl.Path(f).stem)
+        if match is None:
+            raise ValueError(f'Failed to determine checkpoint component name for file "{f}"')
+        # Skip loading components that were not requested (e.g. optimizer state for prediction)
+        if keys is not None and match.group('name') not in keys:
+            continue
+        comps[match.group('name')].append(torch.load(f, map_location=map_location))
     if any([len(v) > 1 for v in comps.values()]):
         raise ValueError(
             f'Found multiple checkpoint files for the same component '
@@ -1,8 +1,56 @@
+import os
+import os.path as osp
+import hashlib
+import pickle
+import tempfile
+import warnings
 import torch
 import numpy as np
 from torchtext.vocab import Vocab
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, namedtuple
 import pandas.core.common as com
+import logging
+logger = logging.getLogger(__name__)
+
+W2VVectors = namedtuple('W2VVectors', ['vocab', 'vectors'])
+
+
+def load_w2v_vectors(path, limit=None, cache_dir=None):
+    """Load binary word2vec vectors, caching the parsed result on disk
+
+    Args:
+        path: Path to binary word2vec model file
+        limit: Maximum number of vectors to load (as in gensim `load_word2vec_format`)
+        cache_dir: Directory in which parsed vectors are cached; defaults to system temp dir
+    Returns:
+        W2VVectors with `vocab` as a dict of word to index and `vectors` as a (memory-mapped) array
+    """
+    path = osp.abspath(path)
+    key = hashlib.md5(f'{path}:{osp.getmtime(path)}:{limit}'.encode('utf-8')).hexdigest()
+    cache_path = osp.join(cache_dir or tempfile.gettempdir(), f'w2v_{key}')
+    vocab_path, vectors_path = cache_path + '.pkl', cache_path + '.npy'
+
+    if not (osp.exists(vocab_path) and osp.exists(vectors_path)):
+        logger.info('Parsing w2v model at %s (limit = %s) into cache %s', path, limit, cache_path)
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message='.*')
+            from gensim.models import KeyedVectors
+            model = KeyedVectors.load_word2vec_format(path, binary=True, limit=limit)
+        os.makedirs(osp.dirname(cache_path), exist_ok=True)
+        # Write both files under process-specific temporary names and move them into place
+        # atomically so concurrent runs never modify a file another run may have memory-mapped;
+        # vocab is moved last so that its presence marks a complete cache entry
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        np.save(cache_path + tmp_suffix + '.npy', model.vectors)
+        os.replace(cache_path + tmp_suffix + '.npy', vectors_path)
+        with open(vocab_path + tmp_suffix, 'wb') as f:
+            pickle.dump(list(model.vocab.keys()), f)
+        os.replace(vocab_path + tmp_suffix, vocab_path)
+
+    with open(vocab_path, 'rb') as f:
+        words = pickle.load(f)
+    vectors = np.load(vectors_path, mmap_mode='r')
+    return W2VVectors(vocab={w: i for i, w in enumerate(words)}, vectors=vectors)
 
 
 class W2VVocab(Vocab):
@@ -12,6 +60,7 @@ class W2VVocab(Vocab):
 
         Args:
             model: Gensim model (e.g. KeyedVectors.load_word2vec_format(W2V_MODEL_01, binary=True, limit=50000))
+                or any object with the same `vocab` and `vectors` attributes (e.g. from `load_w2v_vectors`)
             specials: Extra tokens to add with randomized vectors ("<pad>" is always added first)
             random_state: Random state used to initialized random vectors
         """